@@ -1,11 +1,35 @@
-import os, json, logging, time, random
-from collections import deque
-from flask import Flask, request, jsonify, render_template
-from openai import OpenAI
+import os, logging, math, time, random, hashlib, threading, asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from string import Template
+import httpx
+import orjson
+import tiktoken
+from cachetools import TTLCache
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+import openai
+from openai import AsyncOpenAI
 
-# ---------- Flask setup ----------
-app = Flask(__name__, static_folder="static", template_folder="templates")
-app.config["JSON_AS_ASCII"] = False
+# ---------- FastAPI setup ----------
+# Fully async: /enhance is I/O-bound on OpenRouter, so one event loop multiplexes
+# every in-flight request and retry backoff.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker = asyncio.create_task(batch_worker()) if MAX_BATCH > 1 else None
+    encoder_warmup = asyncio.create_task(asyncio.to_thread(get_encoder))  # noqa: F841 (held so it isn't collected)
+    yield
+    if worker:
+        worker.cancel()
+    await shared_http.aclose()
+
+app = FastAPI(title="Prompt Enhancer", lifespan=lifespan, default_response_class=ORJSONResponse)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
+INDEX_TEMPLATE = templates.get_template("index.html")  # loaded once; skips the loader on every hit
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("prompt-enhancer")
@@ -16,12 +40,76 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 if not OPENROUTER_API_KEY:
     log.warning("OPENROUTER_API_KEY is not set. '/' will work; '/enhance' will 500.")
 
-client = OpenAI(
+# One pooled HTTP/2 client per process so TLS handshakes are amortized across calls.
+# Pool settings go on the transport: httpx ignores the client's own limits/http2 once one is given.
+shared_http = httpx.AsyncClient(
+    timeout=30,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    ),
+)
+
+client = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1",
     api_key=OPENROUTER_API_KEY,
+    http_client=shared_http,
+    max_retries=0,  # call_model owns retries; SDK retries would stack on top of them
 )
 
+# ---------- Response cache ----------
+# Exact-match cache: repeated (domain, tone, input) payloads skip the upstream call.
+# Reads and writes never straddle an await, so the event loop needs no lock here.
+CACHE = TTLCache(maxsize=4096, ttl=3600)
+
+def cache_key(domain: str, tone: str, user_input: str) -> bytes:
+    return hashlib.blake2b(f"{domain}|{tone}|{user_input}".encode(), digest_size=16).digest()
+
+# ---------- Semantic cache (optional) ----------
+# Paraphrased inputs ("rewrite this" / "please rewrite this") reuse a cached result
+# when cosine similarity > SEMANTIC_THRESHOLD and domain/tone match.
+# Off by default: embedding adds ~10-20ms CPU per request. Enable with SEMANTIC_CACHE=1
+# (needs sentence-transformers + hnswlib installed).
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.92"))
+SEMANTIC_MAX = 4096
+SEMANTIC_LOCK = threading.Lock()
+semantic_entries = []  # index label -> {"domain", "tone", "result"}
+embedder = semantic_index = None
+
+if os.getenv("SEMANTIC_CACHE", "0") == "1":
+    try:
+        import hnswlib
+        from sentence_transformers import SentenceTransformer
+        embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        semantic_index = hnswlib.Index(space="cosine", dim=384)
+        semantic_index.init_index(max_elements=SEMANTIC_MAX, ef_construction=200, M=16)
+    except Exception as e:
+        log.warning(f"SEMANTIC_CACHE requested but unavailable: {e}")
+        embedder = semantic_index = None
+
+def semantic_lookup(vec, domain: str, tone: str):
+    with SEMANTIC_LOCK:
+        n = len(semantic_entries)
+        if not n:
+            return None
+        labels, dists = semantic_index.knn_query(vec, k=min(4, n))
+    for label, dist in zip(labels[0], dists[0]):
+        entry = semantic_entries[label]
+        if 1 - dist > SEMANTIC_THRESHOLD and entry["domain"] == domain and entry["tone"] == tone:
+            return entry["result"]
+    return None
+
+def semantic_store(vec, domain: str, tone: str, result: dict):
+    with SEMANTIC_LOCK:
+        if len(semantic_entries) >= SEMANTIC_MAX:
+            return  # index full; exact-match cache still covers repeats
+        semantic_index.add_items(vec, len(semantic_entries))
+        semantic_entries.append({"domain": domain, "tone": tone, "result": result})
+
 # ---------- System Prompt ----------
+# Kept above 1024 tokens (few-shot examples) and byte-for-byte identical on every call,
+# so providers serve it from their prompt-prefix cache. Never interpolate into it.
 SYSTEM_PROMPT = """You are an expert prompt engineer and instruction optimizer.
 Transform the user's raw input into a complete, structured, high-signal prompt for a large language model.
 Rules:
@@ -31,136 +119,532 @@ Rules:
 Return STRICT JSON with keys:
 - enhanced: string
 - improvements: array of short bullets
+
+The examples below show the expected depth and JSON shape. Never copy their content.
+
+Example 1
+Domain hint: auto. Tone hint: auto.
+User Input:
+\"\"\"write a blog post about remote work\"\"\"
+Response:
+{"enhanced": "# Role\\nYou are an experienced workplace-culture writer who publishes practical, well-sourced articles for managers and individual contributors.\\n\\n# Task\\nWrite a blog post about remote work that helps readers decide how to make it work well for their team.\\n\\n# Context\\n- Audience: knowledge workers and first-line managers at small to mid-sized companies.\\n- Assume readers already work remotely at least part-time; skip the basics of what remote work is.\\n\\n# Requirements\\n- Cover three angles: productivity and focus, communication and collaboration, and wellbeing and boundaries.\\n- For each angle give one common pitfall and one concrete, low-cost practice that fixes it.\\n- Cite data only if you are confident it is accurate; otherwise describe the trend qualitatively.\\n\\n# Tone\\nClear, warm, and practical. No hype, no corporate jargon.\\n\\n# Output Format\\n- A compelling title and a two-sentence hook.\\n- Three H2 sections, 150-200 words each.\\n- A closing section with a five-item checklist readers can apply this week.\\n- Total length 800-1000 words.\\n\\n# Quality Checks\\n- Every recommendation must be actionable without buying new tools.\\n- Avoid absolute claims such as 'remote work is always more productive'.", "improvements": ["Added a writer role and target audience", "Scoped the post to three concrete angles", "Specified structure, section lengths and total word count", "Required actionable, tool-free recommendations", "Added guardrails against unsupported statistics"]}
+
+Example 2
+Domain hint: technical. Tone hint: concise.
+User Input:
+\"\"\"my python script is slow when reading a big csv, fix it\"\"\"
+Response:
+{"enhanced": "# Role\\nYou are a senior Python performance engineer.\\n\\n# Task\\nDiagnose why a Python script is slow when reading a large CSV file and propose concrete fixes.\\n\\n# Context\\n- The file may be several GB and may not fit in memory.\\n- The current implementation is unknown; if code is not provided, ask for it and meanwhile cover the most likely causes.\\n\\n# Requirements\\n1. List the likely bottlenecks (row-by-row Python loops, csv module overhead, dtype inference, memory pressure, disk I/O).\\n2. For each, show a minimal code fix: chunked reading with pandas.read_csv(chunksize=...), explicit dtypes and usecols, the pyarrow engine, or polars lazy scanning.\\n3. Explain how to measure the improvement with time.perf_counter or cProfile before and after.\\n\\n# Tone\\nShort, direct sentences. No filler.\\n\\n# Output Format\\n- A numbered list of bottlenecks, each with a code block and a one-line explanation.\\n- A final table comparing approaches by speed, memory use, and added dependencies.\\n\\n# Quality Checks\\n- Code must run on Python 3.10+.\\n- State any assumptions about file size, schema, and available RAM.", "improvements": ["Added a performance-engineer role", "Stated the unknowns and asked for the code", "Enumerated bottlenecks with targeted fixes", "Required before/after measurement", "Defined a comparison table as the output"]}
+
+Example 3
+Domain hint: health. Tone hint: friendly.
+User Input:
+\"\"\"is intermittent fasting good for me\"\"\"
+Response:
+{"enhanced": "# Role\\nYou are a registered dietitian who explains nutrition research in plain language.\\n\\n# Task\\nExplain whether intermittent fasting is likely to be beneficial for the user, and what they should consider before trying it.\\n\\n# Context\\n- The user's age, health conditions, medications, and goals are unknown. Ask up to two clarifying questions, then give general guidance.\\n\\n# Requirements\\n- Summarize the main intermittent fasting patterns (16:8, 5:2, alternate-day).\\n- Describe the evidence for weight loss, insulin sensitivity, and adherence, and note the quality of that evidence (randomized trials versus observational studies).\\n- List who should avoid it or consult a doctor first: pregnancy, diabetes on insulin or sulfonylureas, a history of eating disorders, and adolescents.\\n\\n# Tone\\nWarm and encouraging, but honest about uncertainty.\\n\\n# Output Format\\n- Two clarifying questions first.\\n- Short sections: What it is, What the evidence says, Who should be careful, How to start safely.\\n- End with a three-item checklist.\\n\\n# Quality Checks\\n- Do not present fasting as a treatment for any disease.\\n- Recommend professional advice for anyone with a medical condition.", "improvements": ["Added a dietitian role with plain-language framing", "Allowed two clarifying questions about personal context", "Required evidence-quality labelling", "Added contraindications and safety guidance", "Structured the answer into clear sections and a checklist"]}
+
+Example 4
+Domain hint: creative. Tone hint: persuasive.
+User Input:
+\"\"\"tagline for a coffee shop\"\"\"
+Response:
+{"enhanced": "# Role\\nYou are a brand copywriter who specializes in independent cafes.\\n\\n# Task\\nWrite tagline options for a neighborhood coffee shop.\\n\\n# Context\\n- The shop's name, location, and positioning are unknown. Assume a small independent cafe that competes with chains on quality and atmosphere, and invite the user to share details to tailor the lines.\\n\\n# Requirements\\n- Produce 10 taglines, each 8 words or fewer.\\n- Cover at least four angles: craft and quality, community and belonging, ritual and comfort, and playful wordplay.\\n- Avoid cliches such as 'brewed to perfection' and 'life happens, coffee helps'.\\n\\n# Tone\\nBenefit-led and inviting, with a light, confident voice.\\n\\n# Output Format\\n- A numbered list of taglines, each followed by its angle in parentheses.\\n- Then your top three picks, with one sentence each on why they would work on a storefront sign.\\n\\n# Quality Checks\\n- Every tagline must be easy to say aloud and memorable after one read.\\n- No trademarked slogans from existing brands.", "improvements": ["Added a copywriter role specialized in cafes", "Stated assumptions about the business", "Required 10 short options across four angles", "Banned common cliches", "Asked for a ranked shortlist with rationale"]}
 """
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+USER_TMPL = Template('Domain hint: $domain.\nTone hint: $tone.\nUser Input:\n"""$user_input"""')
+
+def system_message(model_id: str) -> dict:
+    # Anthropic needs an explicit cache breakpoint; OpenAI-style providers cache prefixes automatically
+    if model_id.startswith("anthropic/"):
+        return {"role": "system", "content": [
+            {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+        ]}
+    return SYSTEM_MESSAGE
+
+def log_cache_usage(model_id: str, usage) -> None:
+    if not usage:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or getattr(usage, "cache_read_input_tokens", None) or 0
+    log.info(f"{model_id} prompt_tokens={usage.prompt_tokens} cached_tokens={cached}")
+
+# ---------- Model calls ----------
+# Free model rotation (first is a steady default)
+FREE_MODELS = [
+    "openai/gpt-oss-20b:free",
+    "qwen/qwen3-8b:free",
+    "qwen/qwen3-coder:free",
+    "deepseek/deepseek-r1-0528:free",
+    "deepseek/deepseek-r1:free",
+]
+FANOUT = 3  # models raced concurrently in the first wave
+
+# ---------- Model routing ----------
+# Short asks go to a small model first, code or long specs to the coder model;
+# the rest of FREE_MODELS keeps its order as the fallback rotation.
+ROUTE_SHORT_TOKENS = 64
+ROUTE_LONG_TOKENS = 500
+
+_encoder = {}  # "cl100k" -> tiktoken Encoding, or None when it couldn't be loaded
+_ENCODER_LOCK = threading.Lock()
+
+def get_encoder():
+    """cl100k_base, loaded on first use. tiktoken downloads the BPE file unless it is
+    already in TIKTOKEN_CACHE_DIR; if that fails, returns None and callers estimate
+    ~4 chars per token. Remembered either way, so an offline host doesn't retry per call."""
+    with _ENCODER_LOCK:  # the startup warm-up and a first request may race here
+        if "cl100k" not in _encoder:
+            try:
+                _encoder["cl100k"] = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                log.warning(f"tiktoken encoder unavailable, estimating tokens from length: {e}")
+                _encoder["cl100k"] = None
+        return _encoder["cl100k"]
+
+async def load_encoder():
+    # First load can hit the network: keep it off the event loop.
+    if "cl100k" in _encoder:
+        return _encoder["cl100k"]
+    return await asyncio.to_thread(get_encoder)
+
+def route_models(user_input: str, n_tok: int) -> list:
+    if "```" in user_input or n_tok > ROUTE_LONG_TOKENS:
+        tier, primary = "complex", "qwen/qwen3-coder:free"
+    elif n_tok < ROUTE_SHORT_TOKENS:
+        tier, primary = "simple", "qwen/qwen3-8b:free"
+    else:
+        tier, primary = "default", FREE_MODELS[0]
+    log.info(f"route tier={tier} tokens={n_tok} model={primary}")
+    return [primary] + [m for m in FREE_MODELS if m != primary]
+
+def parse_result(content: str, model_id: str) -> dict:
+    return result_from_payload(orjson.loads(content) if content else {}, model_id)
+
+def result_from_payload(payload: dict, model_id: str) -> dict:
+    enhanced = (payload.get("enhanced") or "").strip()
+    improvements = payload.get("improvements") or []
+    if not enhanced:
+        raise ValueError("Upstream returned empty/malformed JSON")
+    return {
+        "enhanced": enhanced,
+        "improvements": improvements,
+        "model_used": model_id
+    }
+
+@lru_cache(maxsize=8)
+def attribution_headers(referer: str) -> dict:
+    # Optional attribution headers recommended by OpenRouter. One shared dict per host,
+    # reused by every attempt instead of rebuilt per call (never mutate it).
+    return {"HTTP-Referer": referer, "X-Title": "Prompt Enhancer"}
+
+MAX_RETRY_WAIT = 10.0  # seconds; a longer Retry-After means rotate to the next model instead
+
+def retry_delay(e: Exception, attempt: int) -> float:
+    """Provider's Retry-After when given (seconds form), else jittered exponential backoff."""
+    response = getattr(e, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = float(value)
+        if math.isfinite(delay):
+            return max(0.0, delay)  # a negative value would mean back-to-back retries
+    except (TypeError, ValueError):
+        pass
+    return (2 ** attempt) + random.random()
+
+async def call_model(model_id: str, user_prompt: str, referer: str, parse=parse_result):
+    """One model, up to 3 attempts on transient errors. Raises the last error on failure."""
+    for attempt in range(3):
+        try:
+            resp = await client.chat.completions.create(
+                model=model_id,
+                messages=[
+                    system_message(model_id),
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.2,
+                response_format={"type": "json_object"},
+                extra_headers=attribution_headers(referer),
+            )
+
+            log_cache_usage(model_id, resp.usage)
+            return parse(resp.choices[0].message.content, model_id)
+
+        except (openai.RateLimitError, openai.InternalServerError,
+                openai.APITimeoutError, openai.APIConnectionError) as e:
+            # Free-pool saturation (429), upstream 5xx, or network trouble: retry
+            delay = retry_delay(e, attempt)
+            if attempt == 2 or delay > MAX_RETRY_WAIT:
+                log.warning(f"{model_id} gave up after attempt {attempt+1}: {e}")
+                raise
+            log.warning(f"{model_id} attempt {attempt+1} -> {e}; retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        except openai.NotFoundError as e:
+            # The route doesn’t exist (404 / "No endpoints found"); give up on this model
+            log.warning(f"{model_id} not available: {e}")
+            raise
+
+        except Exception:
+            log.exception(f"Non-retryable error on {model_id}")
+            raise
+
+async def first_success(model_ids: list, user_prompt: str, referer: str, parse=parse_result):
+    """Race the given models; return the first valid result and cancel the rest."""
+    pending = {asyncio.create_task(call_model(m, user_prompt, referer, parse)) for m in model_ids}
+    last_err = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_err = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise last_err or RuntimeError("No models to try")
+
+async def enhance_upstream(user_prompt: str, referer: str, models: list = FREE_MODELS, parse=parse_result):
+    """Speculative fan-out: the first wave races, the remaining models are a fallback wave."""
+    last_err = None
+    for wave in (models[:FANOUT], models[FANOUT:]):
+        try:
+            return await first_success(wave, user_prompt, referer, parse)
+        except Exception as e:
+            last_err = e
+    raise last_err
+
+# ---------- Dynamic batching ----------
+# Under load, requests that arrive within MAX_WAIT_MS share one upstream call
+# ("process items 0..N"). A lone request is sent immediately, unbatched.
+# Long inputs skip batching: over-long batches make models drop or merge items.
+# Opt-in: a batch puts several users' inputs in one model context, where one item
+# can prompt-inject into another's result. Set BATCH_MAX > 1 only if that's acceptable.
+MAX_BATCH = int(os.getenv("BATCH_MAX", "1"))  # 1 disables batching
+MAX_WAIT_MS = 30
+BATCH_ITEM_MAX_CHARS = 2000
+batch_queue = asyncio.Queue()  # (future, user_prompt, referer, routed models)
+batch_tasks = set()  # strong refs: the loop only keeps weak ones to running tasks
+
+def spawn_batch(items: list):
+    task = asyncio.create_task(run_batch(items))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+def batch_prompt(user_prompts: list) -> str:
+    items = orjson.dumps([{"id": i, "request": p} for i, p in enumerate(user_prompts)]).decode()
+    return (
+        "Process each item below independently, exactly as if it were the only request.\n"
+        'Return STRICT JSON as {"results": [{"id": int, "enhanced": string, "improvements": string[]}]} '
+        "with one entry per item.\n"
+        f"Items:\n{items}"
+    )
+
+def parse_batch(n: int):
+    def parse(content: str, model_id: str) -> list:
+        payload = orjson.loads(content) if content else {}
+        by_id = {item.get("id"): item for item in payload.get("results") or [] if isinstance(item, dict)}
+        if not by_id:
+            raise ValueError("Upstream returned empty/malformed batch JSON")
+        results = []
+        for i in range(n):
+            try:
+                results.append(result_from_payload(by_id[i], model_id))
+            except (KeyError, ValueError):
+                results.append(None)  # missing/bad item; retried on its own
+        return results
+    return parse
+
+async def run_batch(items: list):
+    if len(items) == 1:
+        fut, user_prompt, referer, models = items[0]
+        try:
+            result = await enhance_upstream(user_prompt, referer, models)
+            if not fut.done():
+                fut.set_result(result)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+
+    # Mixed routes share one call, so a batch uses the default rotation
+    try:
+        results = await enhance_upstream(
+            batch_prompt([item[1] for item in items]), items[0][2], parse=parse_batch(len(items))
+        )
+    except Exception as e:
+        log.warning(f"Batch of {len(items)} failed: {e}; retrying items individually")
+        results = [None] * len(items)
+
+    for item, result in zip(items, results):
+        fut = item[0]
+        if fut.done():
+            continue
+        if result is None:
+            spawn_batch([item])
+        else:
+            fut.set_result(result)
+
+async def batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await batch_queue.get()]
+        # Only wait for company when others are already queued
+        if not batch_queue.empty():
+            deadline = loop.time() + MAX_WAIT_MS / 1000
+            while len(items) < MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        spawn_batch(items)
+
+async def submit_batched(user_prompt: str, referer: str, models: list) -> dict:
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((fut, user_prompt, referer, models))
+    return await fut
+
+# ---------- Streaming (SSE) ----------
+# Opt-in with {"stream": true}. Frames:
+#   data: {"delta": "..."}        raw model text as it arrives
+#   event: reset                  the current model failed; discard deltas so far
+#   event: done  data: {result}   final parsed JSON (same shape as the buffered reply)
+#   event: error data: {"error"}  every model failed
+def sse(data: dict, event: str = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {orjson.dumps(data).decode()}\n\n"
+
+async def stream_enhance(user_prompt: str, referer: str, models: list, on_result):
+    """Stream one model at a time (tokens cannot be raced); rotate on failure."""
+    for model_id in models:
+        parts = []
+        try:
+            stream = await client.chat.completions.create(
+                model=model_id,
+                messages=[
+                    system_message(model_id),
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.2,
+                response_format={"type": "json_object"},
+                stream=True,
+                stream_options={"include_usage": True},
+                extra_headers=attribution_headers(referer),
+            )
+            # Closes the upstream response on every exit (done, error, or the SSE client
+            # going away mid-yield), so the pooled connection slot is released right away.
+            async with stream:
+                async for chunk in stream:
+                    log_cache_usage(model_id, chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        yield sse({"delta": delta})
+            result = parse_result("".join(parts), model_id)
+        except Exception as e:
+            log.warning(f"{model_id} stream failed: {e}")
+            if parts:
+                yield sse({"model": model_id}, event="reset")
+            continue
+
+        yield sse(on_result(result), event="done")
+        return
+
+    yield sse({"error": "All free models are busy right now."}, event="error")
+
+def cached_response(result: dict, stream: bool):
+    if stream:
+        return StreamingResponse(iter([sse(result, event="done")]), media_type="text/event-stream")
+    return ORJSONResponse(result, status_code=200)
+
+# ---------- Rate limit ----------
+# 10 req/min per client IP. With REDIS_URL set, a fixed-window counter in Redis is
+# shared by every worker process; otherwise each process keeps a sliding window per
+# client: a deque of at most RATE_LIMIT timestamps of *allowed* calls, so a blocked
+# client's retries cost nothing and can't push anyone else's history out. Clients
+# are kept in LRU order and the least recently seen is dropped past MAX_TRACKED_IPS.
+RATE_WINDOW = 60
+RATE_LIMIT = 10
+MAX_TRACKED_IPS = 100_000
+recent_calls: "OrderedDict[str, deque]" = OrderedDict()  # client ip -> time.monotonic() stamps
+RATE_LOCK = asyncio.Lock()
+redis_client = None
+
+if os.getenv("REDIS_URL"):
+    import redis.asyncio as redis
+    redis_client = redis.Redis.from_url(os.getenv("REDIS_URL"))
+
+def get_client_ip(request: Request) -> str:
+    # Rightmost X-Forwarded-For hop: the one our proxy (Render) appended. Entries to
+    # its left come from the client and can be rotated freely to dodge the limit.
+    fwd = request.headers.get("x-forwarded-for")
+    if fwd:
+        return fwd[fwd.rfind(",") + 1:].strip()
+    return request.client.host if request.client else "unknown"
+
+async def rate_limited(client_ip: str) -> bool:
+    if redis_client is not None:
+        # Wall clock here: the window key must line up across processes and hosts.
+        key = f"rl:{client_ip}:{int(time.time() // RATE_WINDOW)}"
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                n, _ = await pipe.incr(key).expire(key, RATE_WINDOW + 10).execute()
+            return n > RATE_LIMIT
+        except Exception as e:
+            log.warning(f"Redis rate limit unavailable, using local window: {e}")
+
+    now = time.monotonic()  # immune to NTP steps; only compared within this process
+    async with RATE_LOCK:
+        calls = recent_calls.get(client_ip)
+        if calls is None:
+            calls = recent_calls[client_ip] = deque(maxlen=RATE_LIMIT)
+            if len(recent_calls) > MAX_TRACKED_IPS:
+                recent_calls.popitem(last=False)
+        else:
+            recent_calls.move_to_end(client_ip)
+        if len(calls) == RATE_LIMIT and now - calls[0] < RATE_WINDOW:
+            return True  # not recorded: only allowed calls count toward the window
+        calls.append(now)
+        return False
+
+# ---------- Input budget ----------
+# Over MAX_INPUT_TOKENS, keep the head and tail and drop the middle; past
+# REJECT_INPUT_TOKENS, refuse with 413 instead of sending a huge prompt upstream.
+MAX_INPUT_TOKENS = 3000
+REJECT_INPUT_TOKENS = 20000
+REJECT_INPUT_CHARS = REJECT_INPUT_TOKENS * 8  # checked before tokenizing, so huge bodies cost nothing
+TRUNCATION_NOTE = f"Input exceeded {MAX_INPUT_TOKENS} tokens; the middle was trimmed before enhancing."
+
+def truncate_tokens(user_input: str, toks, enc) -> str:
+    half = MAX_INPUT_TOKENS // 2
+    if enc is None:
+        return user_input[:half * 4] + "\n[…]\n" + user_input[-half * 4:]
+    return enc.decode(toks[:half]) + "\n[…]\n" + enc.decode(toks[-half:])
+
+# ---------- Input hints ----------
+DOMAINS = frozenset({"auto", "analytical", "technical", "creative", "health"})
+TONES = frozenset({"auto", "concise", "formal", "friendly", "persuasive", "neutral"})
+
+def pick_hint(value, allowed: frozenset) -> str:
+    """Canonical values pass through untouched; anything unknown becomes 'auto'."""
+    if not isinstance(value, str) or not value:
+        return "auto"
+    if value in allowed:
+        return value
+    value = value.strip().lower()
+    return value if value in allowed else "auto"
 
 # ---------- Routes ----------
-@app.route("/", methods=["GET"])
-def home():
-    return render_template("index.html")
+@app.get("/")
+async def home(request: Request):
+    return HTMLResponse(INDEX_TEMPLATE.render(request=request))
 
-@app.route("/health", methods=["GET"])
-def health():
-    return "ok", 200
+@app.get("/health")
+async def health():
+    return PlainTextResponse("ok", status_code=200)
 
-@app.route("/enhance", methods=["POST"])
-def enhance():
+@app.post("/enhance")
+async def enhance(request: Request):
     # ---- Parse input ----
     try:
-        data = request.get_json(force=True, silent=False) or {}
+        data = orjson.loads(await request.body()) or {}
     except Exception as e:
         log.exception("Invalid JSON body")
-        return jsonify({"error": f"Invalid JSON body: {e}"}), 400
+        return ORJSONResponse({"error": f"Invalid JSON body: {e}"}, status_code=400)
 
     user_input = (data.get("input") or "").strip()
-    domain = (data.get("domain") or "auto").strip().lower()
-    tone = (data.get("tone") or "auto").strip().lower()
+    domain = pick_hint(data.get("domain"), DOMAINS)
+    tone = pick_hint(data.get("tone"), TONES)
+    stream = bool(data.get("stream"))
 
     if not user_input:
-        return jsonify({"error": "Missing 'input'"}), 400
+        return ORJSONResponse({"error": "Missing 'input'"}, status_code=400)
     if not OPENROUTER_API_KEY:
-        return jsonify({"error": "Server misconfigured: OPENROUTER_API_KEY not set"}), 500
+        return ORJSONResponse({"error": "Server misconfigured: OPENROUTER_API_KEY not set"}, status_code=500)
 
-    user_prompt = (
-        f"Domain hint: {domain if domain != 'auto' else 'auto-detect'}.\n"
-        f"Tone hint: {tone if tone != 'auto' else 'auto-select (clear, helpful)'}.\n"
-        "User Input:\n"
-        f"\"\"\"{user_input}\"\"\""
-    )
+    # ---- Token budget ----
+    if len(user_input) > REJECT_INPUT_CHARS:
+        return ORJSONResponse({
+            "error": f"Input is too long ({len(user_input)} characters; limit {REJECT_INPUT_CHARS})."
+        }, status_code=413)
+    enc = await load_encoder()
+    # A full BPE pass over up to REJECT_INPUT_CHARS: keep it off the event loop.
+    toks = await asyncio.to_thread(enc.encode_ordinary, user_input) if enc is not None else None
+    n_tok = len(toks) if toks is not None else len(user_input) // 4
+    if n_tok > REJECT_INPUT_TOKENS:
+        return ORJSONResponse({
+            "error": f"Input is too long ({n_tok} tokens; limit {REJECT_INPUT_TOKENS})."
+        }, status_code=413)
+    truncated = n_tok > MAX_INPUT_TOKENS
+    if truncated:
+        user_input = truncate_tokens(user_input, toks, enc)
 
-    # ---- Simple in-memory rate limit: 10 req/min per instance ----
-    # Prevents bursts that cause 429 on free pools
-    if not hasattr(app, "recent_calls"):
-        app.recent_calls = deque()
-    now = time.time()
-    window = 60
-    limit = 10
-    app.recent_calls.append(now)
-    while app.recent_calls and now - app.recent_calls[0] > window:
-        app.recent_calls.popleft()
-    if len(app.recent_calls) > limit:
-        return jsonify({
-            "error": "Too many requests from this app right now. Please try again in a few seconds."
-        }), 429
-
-    # ---- Free model rotation (first is a steady default) ----
-    free_models = [
-        "openai/gpt-oss-20b:free",
-        "qwen/qwen3-8b:free",
-        "qwen/qwen3-coder:free",
-        "deepseek/deepseek-r1-0528:free",
-        "deepseek/deepseek-r1:free",
-    ]
+    # ---- Exact-match cache hit: no upstream call, no rate-limit charge ----
+    key = cache_key(domain, tone, user_input)
+    cached = CACHE.get(key)
+    if cached:
+        return cached_response(cached, stream)
 
-    last_err = None
+    # ---- Rate limit: 10 req/min per client ----
+    # Prevents bursts that cause 429 on free pools. Checked before embedding so the
+    # embedder's CPU time is charged too; only exact-match hits above are free.
+    if await rate_limited(get_client_ip(request)):
+        return ORJSONResponse({
+            "error": "Too many requests right now. Please try again in a few seconds."
+        }, status_code=429)
 
-    for model_id in free_models:
-        for attempt in range(3):  # up to 3 retries per model on transient errors
-            try:
-                resp = client.chat.completions.create(
-                    model=model_id,
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    temperature=0.2,
-                    response_format={"type": "json_object"},
-                    # Optional attribution headers recommended by OpenRouter
-                    extra_headers={
-                        "HTTP-Referer": request.host_url.rstrip("/"),
-                        "X-Title": "Prompt Enhancer",
-                    },
-                )
-
-                content = resp.choices[0].message.content
-                payload = json.loads(content) if content else {}
-                enhanced = (payload.get("enhanced") or "").strip()
-                improvements = payload.get("improvements") or []
-                if not enhanced:
-                    raise ValueError("Upstream returned empty/malformed JSON")
-
-                return jsonify({
-                    "enhanced": enhanced,
-                    "improvements": improvements,
-                    "model_used": model_id
-                }), 200
+    # ---- Semantic cache hit: near-duplicate of an earlier input ----
+    vec = None
+    if semantic_index is not None:
+        # 10-20 ms of model inference: run it in a thread, not on the event loop.
+        vec = await asyncio.to_thread(embedder.encode, user_input, normalize_embeddings=True)
+        cached = semantic_lookup(vec, domain, tone)
+        if cached:
+            return cached_response(cached, stream)
 
-            except Exception as e:
-                msg = str(e)
-                # Retry on free-pool saturation / transient errors
-                transient = (
-                    "429" in msg
-                    or "rate" in msg.lower()
-                    or "temporarily" in msg.lower()
-                    or "timeout" in msg.lower()
-                    or "5" == msg[:1]  # generic 5xx string-start
-                )
-                if transient and attempt < 2:
-                    backoff = (2 ** attempt) + random.random()
-                    log.warning(f"{model_id} attempt {attempt+1} -> {e}; retrying in {backoff:.2f}s")
-                    time.sleep(backoff)
-                    last_err = e
-                    continue
-
-                # If the route doesn’t exist (404), move to next model
-                if "No endpoints found" in msg or "404" in msg:
-                    log.warning(f"{model_id} not available: {e}")
-                    last_err = e
-                    break
+    user_prompt = USER_TMPL.substitute(
+        domain=domain if domain != "auto" else "auto-detect",
+        tone=tone if tone != "auto" else "auto-select (clear, helpful)",
+        user_input=user_input,
+    )
+
+    referer = str(request.base_url).rstrip("/")
+    models = route_models(user_input, n_tok)
+
+    def remember(result: dict) -> dict:
+        if truncated:
+            result = {**result, "note": TRUNCATION_NOTE}
+        CACHE[key] = result
+        if vec is not None:
+            semantic_store(vec, domain, tone, result)
+        return result
 
-                # Non-retryable; try next model
-                log.exception(f"Non-retryable error on {model_id}")
-                last_err = e
-                break
+    if stream:
+        return StreamingResponse(stream_enhance(user_prompt, referer, models, remember), media_type="text/event-stream")
+
+    try:
+        if MAX_BATCH > 1 and len(user_input) <= BATCH_ITEM_MAX_CHARS:
+            result = await submit_batched(user_prompt, referer, models)
+        else:
+            result = await enhance_upstream(user_prompt, referer, models)
+    except Exception:
+        # Exhausted all models
+        log.exception("All free models unavailable")
+        return ORJSONResponse({
+            "error": "All free models are busy right now.",
+            "hint": "Please try again in a minute — pools refill quickly."
+        }, status_code=503)
 
-    # Exhausted all models
-    log.exception("All free models unavailable", exc_info=last_err)
-    return jsonify({
-        "error": "All free models are busy right now.",
-        "hint": "Please try again in a minute — pools refill quickly."
-    }), 503
+    return ORJSONResponse(remember(result), status_code=200)
 
 
 if __name__ == "__main__":
-    # Local dev only; Render will use Gunicorn/Procfile
+    # Equivalent to: uvicorn app:app --workers 2 --loop uvloop
+    import uvicorn
     port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+    uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop")
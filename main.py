@@ -1,48 +1,113 @@
 # ... (imports & config stay the same)
+import asyncio, hashlib, ipaddress, logging, math, random, re, socket, sqlite3, time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, closing
+from functools import lru_cache
+from itertools import count
+from typing import Optional
+import ijson
+import orjson
+from cachetools import TTLCache
+from fastapi.responses import ORJSONResponse, Response
+from openai import AsyncOpenAI, NotFoundError, OpenAIError
+
+# --- UPDATED: index template loaded once at import (was templates.TemplateResponse per request) ---
+INDEX_TEMPLATE = templates.get_template("index.html")
+
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    return HTMLResponse(INDEX_TEMPLATE.render(request=request))
+
+
+# --- NEW: one pooled OpenRouter client per process, opened/closed with the app ---
+# Keep-alive reuse skips a TCP+TLS handshake on every Pro call; auth and attribution
+# headers live on the client so each post reuses them.
+# Composed onto whatever lifespan the app already has (on_event hooks are deprecated,
+# and Starlette skips them entirely once a lifespan= is set).
+_app_lifespan = app.router.lifespan_context
+OPENROUTER_REFERER = os.getenv("OPENROUTER_REFERER", "https://babubl.github.io/prompt-enhancer")  # attribution only
+
+
+@asynccontextmanager
+async def lifespan(app_):
+    # Explicit transport: HTTP/2 so concurrent and hedged calls multiplex over one
+    # connection, TCP_NODELAY, and no transport-level retries (_try_model owns those).
+    # Limits live on the transport because the client ignores its own once one is given.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+    )
+    app.state.http_client = httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        transport=transport,
+        headers={
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "HTTP-Referer": OPENROUTER_REFERER,
+            "X-Title": "PromptOS-Public",
+            "Content-Type": "application/json",  # bodies are pre-encoded with orjson and sent as content=
+        },
+    )
+    app.state.bucket_sweeper = asyncio.create_task(_sweep_ip_buckets())
+    try:
+        async with _app_lifespan(app_) as state:
+            yield state
+    finally:
+        app.state.bucket_sweeper.cancel()
+        await app.state.http_client.aclose()
+
+
+app.router.lifespan_context = lifespan
+
+
+# --- NEW: exact-match cache for Pro results, keyed after mode inference ---
+CACHE = TTLCache(maxsize=4096, ttl=3600)
+
+def cache_key(mode: str, tone: str, user_input: str) -> bytes:
+    return hashlib.blake2b(f"{mode}|{tone}|{user_input}".encode(), digest_size=16).digest()
+
 
 # --- NEW: simple keyword-based mode inference ---
+HEALTH_KW = ["health", "gut", "diet", "nutrition", "nutrient", "digest", "digestion",
+             "ibs", "microbiome", "food", "coriander", "cilantro", "herb", "spice"]
+TECH_KW = ["code", "bug", "api", "deploy", "docker", "python", "javascript", "error", "stack trace"]
+# One compiled alternation per class: a single linear scan instead of a substring scan per keyword.
+# No \b anchors, so matching stays substring-based as before ("diets", "debugging" still hit).
+HEALTH_RE = re.compile("|".join(map(re.escape, HEALTH_KW)), re.I)
+TECH_RE = re.compile("|".join(map(re.escape, TECH_KW)), re.I)
+
+
 def infer_mode(text: str) -> str:
-    t = (text or "").lower()
-    health_kw = ["health", "gut", "diet", "nutrition", "nutrient", "digest", "digestion",
-                 "ibs", "microbiome", "food", "coriander", "cilantro", "herb", "spice"]
-    tech_kw = ["code", "bug", "api", "deploy", "docker", "python", "javascript", "error", "stack trace"]
+    t = text or ""
     # prioritize health if any match
-    if any(k in t for k in health_kw):
+    if HEALTH_RE.search(t):
         return "health"
-    if any(k in t for k in tech_kw):
+    if TECH_RE.search(t):
         return "technical"
     return "analytical"  # general analysis as safe default
 
 
-def deterministic_enhance(raw: str, mode: str, tone: str) -> Dict[str, Any]:
-    raw = (raw or "").strip()
-    # --- UPDATED: better labels + new 'health' mode ---
-    mode_hints = {
-        "analytical": "You are a general analyst. Provide structured reasoning, assumptions, risks, and a decision rubric.",
-        "technical":  "You are a senior software engineer. Provide step-by-step instructions, examples, edge cases, and complexity notes.",
-        "creative":   "You are a creative editor. Provide voice, hook, narrative structure, and audience focus.",
-        "health":     "You are a clinician/nutritionist. Provide evidence-aware advice, mechanisms of action, safety, contraindications, and practical guidance."
-    }
-    tone_hints = {
-        "concise":     "Short, direct sentences. No filler.",
-        "formal":      "Professional, precise, no slang.",
-        "friendly":    "Warm, encouraging, and approachable.",
-        "persuasive":  "Benefit-led framing with a soft CTA.",
-        "neutral":     "Balanced, objective tone.",
-    }
-
-    # --- NEW: auto reroute to health/tech when user left default ---
-    if mode not in mode_hints or mode == "auto":
-        mode = infer_mode(raw)
-
-    mh = mode_hints.get(mode, mode_hints["analytical"])
-    th = tone_hints.get(tone, tone_hints["concise"])
+# --- UPDATED: better labels + new 'health' mode ---
+MODE_HINTS = {
+    "analytical": "You are a general analyst. Provide structured reasoning, assumptions, risks, and a decision rubric.",
+    "technical":  "You are a senior software engineer. Provide step-by-step instructions, examples, edge cases, and complexity notes.",
+    "creative":   "You are a creative editor. Provide voice, hook, narrative structure, and audience focus.",
+    "health":     "You are a clinician/nutritionist. Provide evidence-aware advice, mechanisms of action, safety, contraindications, and practical guidance."
+}
+TONE_HINTS = {
+    "concise":     "Short, direct sentences. No filler.",
+    "formal":      "Professional, precise, no slang.",
+    "friendly":    "Warm, encouraging, and approachable.",
+    "persuasive":  "Benefit-led framing with a soft CTA.",
+    "neutral":     "Balanced, objective tone.",
+}
+TOKEN_RE = re.compile(r"[A-Za-z0-9\-]{3,}")
+JSON_RE = re.compile(r"\{[\s\S]*\}")  # outermost {...}, to salvage JSON wrapped in prose/fences
 
-    import re
-    toks = re.findall(r"[A-Za-z0-9\-]{3,}", raw)
-    ents = ", ".join(sorted(set(toks)))[:300] or "N/A"
-
-    enhanced = f"""# Role
+# Built once; only the slots are filled per call (str.format_map), so the fixed text is byte-identical every time.
+_SKELETON = """# Role
 {mh}
 
 # Task
@@ -56,7 +121,7 @@ Write a clear, structured response that directly fulfills the user's intent.
 - Keep within 250–400 words unless clinical nuance or citations are essential.
 
 # Tone
-- {tone.capitalize()}. {th}
+- {tone_label}. {th}
 
 # Output Format
 - Use headings and bullet points when helpful.
@@ -68,58 +133,454 @@ Write a clear, structured response that directly fulfills the user's intent.
 # Context Hints
 - Entities detected: {ents}
 """
-    improvements = [
+
+
+# Inputs up to this size are memoized; longer ones are recomputed, since each entry
+# holds the input twice (key + rendered skeleton) and /enhance has no size cap.
+MEMO_MAX_CHARS = 4096
+
+
+def deterministic_enhance(raw: str, mode: str, tone: str) -> Dict[str, Any]:
+    # The memoized core returns immutable pieces; each caller gets a fresh dict
+    # because the Pro fallback path adds a "note" to the one it receives.
+    core = _deterministic_core if len(raw or "") <= MEMO_MAX_CHARS else _deterministic_core.__wrapped__
+    enhanced, improvements = core(raw, mode, tone)
+    return {"enhanced": enhanced, "improvements": list(improvements), "model_used": "deterministic-fallback"}
+
+
+@lru_cache(maxsize=1024)
+def _deterministic_core(raw: str, mode: str, tone: str) -> Tuple[str, Tuple[str, ...]]:
+    raw = (raw or "").strip()
+
+    # --- NEW: auto reroute to health/tech when user left default ---
+    if mode not in MODE_HINTS or mode == "auto":
+        mode = infer_mode(raw)
+
+    mh = MODE_HINTS.get(mode, MODE_HINTS["analytical"])
+    th = TONE_HINTS.get(tone, TONE_HINTS["concise"])
+
+    # Order-preserving dedup that stops once the 300-char hint budget is full,
+    # instead of sorting every token and truncating the joined string.
+    seen, out, used = set(), [], 0
+    for m in TOKEN_RE.finditer(raw):  # lazy: stops scanning when the budget fills
+        t = m.group()
+        if t in seen:
+            continue
+        seen.add(t)
+        if used + len(t) + 2 > 300:
+            break
+        out.append(t)
+        used += len(t) + 2
+    ents = ", ".join(out) or "N/A"
+
+    enhanced = _SKELETON.format_map({"mh": mh, "raw": raw, "tone_label": tone.capitalize(), "th": th, "ents": ents})
+    improvements = (
         f"Mode preset applied: {mode}",
         f"Tone guidance applied: {tone}",
         "Added structure: Role, Task, Intent, Constraints, Tone, Output, Checks",
         "Added anti-hallucination guidance & clarifying-question allowance",
         "Included naive entity/context hints",
-    ]
-    return {"enhanced": enhanced, "improvements": improvements, "model_used": "deterministic-fallback"}
+    )
+    return enhanced, improvements
 
 
-async def openrouter_enhance(user_input: str, mode: str, tone: str) -> Dict[str, Any]:
-    # ... (env/key checks same)
+# --- NEW: pro-tier prompt pieces built once at import (were rebuilt inside build_prompts per call) ---
+PRO_SYSTEM_PROMPT = (
+    "You are an expert prompt engineer. Transform the user's raw input into a complete, structured, high-signal prompt "
+    "for a large language model. Preserve intent; add role, task, context, constraints, tone, output format, "
+    "and quality checks when helpful. Return STRICT JSON as {\"enhanced\": string, \"improvements\": string[]}."
+)
+PRO_MODE_HINTS = {
+    "analytical": "Focus on analysis structure, assumptions, risks, decision criteria.",
+    "technical":  "Focus on steps, examples, edge cases, and code-ready outputs.",
+    "creative":   "Focus on voice, hooks, story structure, and audience fit.",
+    "health":     "Focus on evidence-aware advice, safety, contraindications, and mechanisms of action.",
+}
+PRO_TONE_HINTS = {
+    "concise":    "Short, direct sentences. Remove filler.",
+    "formal":     "Professional, precise language.",
+    "friendly":   "Warm and approachable, but clear.",
+    "persuasive": "Benefit-first framing; conclude with a CTA.",
+    "neutral":    "Informative and balanced."
+}
 
+
+def _user_prefix(mode: str, tone: str) -> str:
+    mode_hint = PRO_MODE_HINTS.get(mode, "Focus on clarity and structure.")
+    tone_hint = PRO_TONE_HINTS.get(tone, "Keep it neutral and clear.")
+    return f"Mode: {mode} ({mode_hint})\nTone: {tone} ({tone_hint})\n\nUser Input:\n\"\"\""
+
+
+_USER_PREFIX = {(m, t): _user_prefix(m, t) for m in PRO_MODE_HINTS for t in PRO_TONE_HINTS}
+
+
+def build_prompts(user_input: str, mode: str, tone: str) -> Tuple[str, str]:
     # --- UPDATED: include health mapping and auto infer if needed ---
     if mode == "auto" or mode not in {"analytical", "technical", "creative", "health"}:
         mode = infer_mode(user_input)
 
-    mode_hint = {
-        "analytical": "Focus on analysis structure, assumptions, risks, decision criteria.",
-        "technical":  "Focus on steps, examples, edge cases, and code-ready outputs.",
-        "creative":   "Focus on voice, hooks, story structure, and audience fit.",
-        "health":     "Focus on evidence-aware advice, safety, contraindications, and mechanisms of action.",
-    }.get(mode, "Focus on clarity and structure.")
-
-    tone_hint = {
-        "concise":    "Short, direct sentences. Remove filler.",
-        "formal":     "Professional, precise language.",
-        "friendly":   "Warm and approachable, but clear.",
-        "persuasive": "Benefit-first framing; conclude with a CTA.",
-        "neutral":    "Informative and balanced."
-    }.get(tone, "Keep it neutral and clear.")
-
-    system = (
-        "You are an expert prompt engineer. Transform the user's raw input into a complete, structured, high-signal prompt "
-        "for a large language model. Preserve intent; add role, task, context, constraints, tone, output format, "
-        "and quality checks when helpful. Return STRICT JSON as {\"enhanced\": string, \"improvements\": string[]}."
+    # --- UPDATED: constant system prompt + precomputed (mode, tone) prefix; only unknown tones format here ---
+    prefix = _USER_PREFIX.get((mode, tone)) or _user_prefix(mode, tone)
+    return PRO_SYSTEM_PROMPT, prefix + user_input.strip() + '"""'
+
+
+def parse_model_json(content: str) -> Dict[str, Any]:
+    # --- UPDATED: salvage step uses the precompiled JSON_RE (was an inline `import re` + re.search) ---
+    try:
+        return orjson.loads(content)
+    except Exception:
+        m = JSON_RE.search(content or "")
+        if m:
+            try:
+                return orjson.loads(m.group(0))
+            except Exception:
+                pass
+    raise ValueError("Non-JSON or invalid JSON")
+
+
+# --- NEW: hedged model rotation ---
+# The next model is fired alongside the ones in flight after HEDGE_DELAY seconds
+# without an answer (or at once when they have all failed); the first valid JSON
+# wins and the rest are cancelled. A stalled free model no longer burns the whole
+# HTTP_TIMEOUT before the next one is tried.
+HEDGE_DELAY = 2.0
+
+
+async def _stream_content(r: httpx.Response) -> str:
+    """Pull choices[0].message.content out of the body as it arrives, without building the full JSON tree."""
+    found = ijson.sendable_list()
+    parser = ijson.items_coro(found, "choices.item.message.content")
+    async for chunk in r.aiter_bytes():
+        parser.send(chunk)
+    parser.close()
+    if not found:
+        raise ValueError("No choices[0].message.content in response")
+    return found[0]
+
+
+# --- NEW: jittered exponential backoff (replaces RETRY_BACKOFFS and the _sleep helper in config) ---
+RETRY_ATTEMPTS = 3
+RETRY_BASE = 0.5
+RETRY_CAP = 8.0  # seconds; a longer Retry-After gives up on this model so the hedge moves on
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Retry-After (seconds form) when the provider sent one, else base * 2^n scaled by 0.5-1.5 jitter."""
+    try:
+        delay = float(retry_after)
+        if math.isfinite(delay):
+            return max(0.0, delay)  # a negative value would mean back-to-back retries
+    except (TypeError, ValueError):
+        pass
+    return min(RETRY_CAP, RETRY_BASE * (2 ** attempt) * (0.5 + random.random()))
+
+
+async def _try_model(client: httpx.AsyncClient, model: str, base_payload: Dict[str, Any]) -> Dict[str, Any]:
+    """One model with jittered backoff; raises RuntimeError(last_error) when it gives up."""
+    body = orjson.dumps({**base_payload, "model": model})  # encoded once, reused across retries
+    last_error = None
+    for attempt in range(RETRY_ATTEMPTS):
+        retry_after = None
+        try:
+            async with client.stream("POST", OPENROUTER_BASE_URL, content=body) as r:
+                if r.status_code == 200:
+                    content = await _stream_content(r)
+                    obj = parse_model_json(content)
+                    enhanced = (obj.get("enhanced") or "").strip()
+                    if not enhanced:
+                        raise ValueError("Non-JSON or invalid JSON")
+                    return {"enhanced": enhanced, "improvements": obj.get("improvements") or [], "model_used": model}
+                await r.aread()
+            last_error = f"{model}: HTTP {r.status_code}"
+            if r.status_code != 429 and r.status_code < 500:
+                break
+            if r.status_code == 429:
+                retry_after = r.headers.get("retry-after")
+        except httpx.TransportError as e:  # includes TimeoutException: worth another attempt
+            last_error = f"{model}: {e}"
+        except (ValueError, ijson.JSONError) as e:  # bad body: retrying the same model won't fix it
+            last_error = f"{model}: {e}"
+            break
+        if attempt == RETRY_ATTEMPTS - 1:
+            break
+        delay = _backoff(attempt, retry_after)
+        if delay > RETRY_CAP:
+            break
+        await asyncio.sleep(delay)
+    raise RuntimeError(last_error or f"{model}: no response")
+
+
+async def openrouter_enhance(user_input: str, mode: str, tone: str) -> Dict[str, Any]:
+    # ... (env/key checks same)
+
+    system, user = build_prompts(user_input, mode, tone)
+    # --- UPDATED: messages built once and shared by every model in the rotation ---
+    base_payload = {
+        "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+        "temperature": 0.2,
+    }
+
+    # --- UPDATED: shared pooled client (was a per-call `async with httpx.AsyncClient(...)`) ---
+    client: httpx.AsyncClient = app.state.http_client
+
+    # --- UPDATED: hedged rotation over OPENROUTER_MODELS (was strictly serial) ---
+    queue = list(OPENROUTER_MODELS)
+    pending = set()
+    last_error = None
+    try:
+        while queue or pending:
+            if queue:
+                pending.add(asyncio.create_task(_try_model(client, queue.pop(0), base_payload)))
+            done, pending = await asyncio.wait(
+                pending, timeout=HEDGE_DELAY if queue else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_error = str(task.exception())
+    finally:
+        for task in pending:
+            task.cancel()
+    raise RuntimeError(last_error or "All models failed")
+
+
+# --- NEW: 'batch' tier via the OpenAI Batch API (50% cheaper, 24h completion window) ---
+# OpenRouter has no batch endpoint, so this tier talks to OpenAI directly.
+BATCH_MODEL = os.getenv("BATCH_MODEL", "gpt-4o-mini")
+BATCH_DB = os.getenv("BATCH_DB", "batches.sqlite3")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+batch_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+log = logging.getLogger("prompt-enhancer")
+
+
+def _batch_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(BATCH_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, mode TEXT, tone TEXT, created INTEGER)")
+    return conn
+
+
+BATCH_FAILED = frozenset({"failed", "expired", "cancelled"})
+
+
+async def _discard_batch(batch) -> None:
+    # Once a result is read (or can never be), drop the prompt and reply from OpenAI
+    # and forget the id locally: nothing is retained, and a later poll gets 404.
+    for file_id in (batch.input_file_id, batch.output_file_id, batch.error_file_id):
+        if file_id:
+            try:
+                await batch_client.files.delete(file_id)
+            except OpenAIError as e:
+                log.warning(f"could not delete batch file {file_id}: {e}")
+    with closing(_batch_db()) as conn, conn:
+        conn.execute("DELETE FROM batches WHERE id = ?", (batch.id,))
+
+
+async def submit_batch(user_input: str, mode: str, tone: str) -> ORJSONResponse:
+    if batch_client is None:
+        return ORJSONResponse({"error": "batch tier unavailable: OPENAI_API_KEY not set"}, status_code=503)
+
+    system, user = build_prompts(user_input, mode, tone)
+    line = {
+        "custom_id": "enhance-0",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": BATCH_MODEL,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"},
+        },
+    }
+    upload = None
+    try:
+        upload = await batch_client.files.create(
+            file=("enhance.jsonl", orjson.dumps(line) + b"\n"), purpose="batch"
+        )
+        batch = await batch_client.batches.create(
+            input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+    except OpenAIError as e:
+        if upload is not None:  # don't leave the prompt on OpenAI's side for a batch that never started
+            try:
+                await batch_client.files.delete(upload.id)
+            except OpenAIError:
+                log.warning(f"could not delete batch file {upload.id}")
+        return ORJSONResponse({"error": f"batch submit failed: {str(e)[:120]}"}, status_code=502)
+    with closing(_batch_db()) as conn, conn:
+        conn.execute("INSERT INTO batches VALUES (?, ?, ?, ?)", (batch.id, mode, tone, int(time.time())))
+
+    return ORJSONResponse(
+        {"batch_id": batch.id, "status": batch.status, "poll": f"/enhance/batch/{batch.id}"},
+        status_code=202,
     )
 
-    user = f"Mode: {mode} ({mode_hint})\nTone: {tone} ({tone_hint})\n\nUser Input:\n\"\"\"{user_input.strip()}\"\"\""
 
-    # ... (httpx request/rotation/retry logic unchanged)
+@app.get("/enhance/batch/{batch_id}", response_class=ORJSONResponse)
+async def enhance_batch(batch_id: str):
+    if batch_client is None:
+        return ORJSONResponse({"error": "batch tier unavailable: OPENAI_API_KEY not set"}, status_code=503)
+    with closing(_batch_db()) as conn:
+        if conn.execute("SELECT 1 FROM batches WHERE id = ?", (batch_id,)).fetchone() is None:
+            return ORJSONResponse({"error": "unknown batch id"}, status_code=404)
+
+    try:
+        batch = await batch_client.batches.retrieve(batch_id)
+    except NotFoundError:
+        with closing(_batch_db()) as conn, conn:
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+        return ORJSONResponse({"error": "unknown batch id"}, status_code=404)
+    except OpenAIError as e:
+        return ORJSONResponse({"batch_id": batch_id, "error": f"batch lookup failed: {str(e)[:120]}"}, status_code=502)
+    if batch.status in BATCH_FAILED:
+        await _discard_batch(batch)
+        return ORJSONResponse({"batch_id": batch_id, "status": batch.status, "error": f"batch {batch.status}"}, status_code=502)
+    if batch.status != "completed":
+        return ORJSONResponse({"batch_id": batch_id, "status": batch.status}, status_code=202)
+
+    try:
+        file_id = batch.output_file_id or batch.error_file_id
+        if file_id is None:
+            raise ValueError("batch completed without an output or error file")
+        output = await batch_client.files.content(file_id)
+        line = orjson.loads(output.text.splitlines()[0])
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            err = line.get("error") or (response.get("body") or {}).get("error") or {}
+            raise ValueError(err.get("message") or f"HTTP {response.get('status_code')}")
+        obj = parse_model_json(response["body"]["choices"][0]["message"]["content"])
+        if not isinstance(obj, dict):
+            raise ValueError("Non-JSON or invalid JSON")
+    except (ValueError, KeyError, IndexError, TypeError, OpenAIError) as e:
+        return ORJSONResponse(
+            {"batch_id": batch_id, "status": batch.status, "error": f"batch result unusable: {str(e)[:120]}"},
+            status_code=502,
+        )
+    finally:
+        await _discard_batch(batch)
+
+    return ORJSONResponse({
+        "batch_id": batch_id,
+        "status": batch.status,
+        "enhanced": (obj.get("enhanced") or "").strip(),
+        "improvements": obj.get("improvements") or [],
+        "model_used": f"{BATCH_MODEL} (batch)",
+    }, status_code=200)
+
+
+# --- UPDATED: client IP without ipaddress on the common path ---
+# A clean dotted-quad (nearly every request) is accepted by one precompiled
+# regex; only anything else pays for ipaddress.ip_address validation.
+# ASCII-only octets 0-255 without leading zeros: exactly what ipaddress accepts.
+_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+_IPV4_RE = re.compile(rf"{_OCTET}(?:\.{_OCTET}){{3}}")
+
+
+def get_client_ip(request: Request) -> str:
+    fwd = request.headers.get("x-forwarded-for")
+    if fwd:
+        # Rightmost hop is the one our proxy appended; entries left of it are client-supplied.
+        ip = fwd[fwd.rfind(",") + 1:].strip()
+    else:
+        ip = request.client.host if request.client else ""
+    if _IPV4_RE.fullmatch(ip):
+        return ip
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return "0.0.0.0"
+
+
+# --- UPDATED: counters are one itertools.count() per metric (was a dict of ints) ---
+# next() on a count is a single C call, so increments can't interleave the way
+# COUNTERS[k] += 1 can across threads. /metrics serves cached bytes and only
+# re-serializes when a counter moved and the last snapshot is over a second old.
+COUNTERS = {k: count() for k in ("free_calls", "pro_calls", "fallback_uses", "blocked_rate")}
+METRICS_TTL = 1.0
+_metrics_cache = {"at": 0.0, "values": None, "body": b"{}"}
+
 
+def bump(name: str) -> None:
+    next(COUNTERS[name])
 
-@app.post("/enhance", response_class=JSONResponse)
+
+def _counter_value(c: count) -> int:
+    return int(repr(c)[6:-1])  # "count(42)"; reading never advances it
+
+
+@app.get("/metrics")
+async def metrics():
+    now = time.monotonic()
+    if now - _metrics_cache["at"] >= METRICS_TTL:
+        values = tuple(_counter_value(c) for c in COUNTERS.values())
+        if values != _metrics_cache["values"]:
+            _metrics_cache["values"] = values
+            _metrics_cache["body"] = orjson.dumps(dict(zip(COUNTERS, values)))
+        _metrics_cache["at"] = now
+    return Response(_metrics_cache["body"], media_type="application/json")
+
+
+# --- UPDATED: token-bucket rate limiter (O(1) per request, one tuple per IP) ---
+# Each IP holds up to RATE_LIMIT_MAX tokens, refilled continuously at
+# RATE_LIMIT_MAX per RATE_LIMIT_WINDOW. Replaces the per-IP timestamp lists
+# that were filtered and rebuilt on every hit.
+# Bounded: least-recently-seen IPs are evicted past MAX_IPS, and a background
+# sweep drops idle entries, so IP churn/spoofing cannot grow it without limit.
+# Sharded by IP hash into 16 small LRU dicts: each hit touches one small dict,
+# and the sweeper yields to the event loop between shards instead of walking
+# every tracked IP in one blocking pass.
+N_SHARDS = 16  # power of two; shard = hash(ip) & (N_SHARDS - 1)
+_BUCKETS: List["OrderedDict[str, Tuple[float, float]]"] = [OrderedDict() for _ in range(N_SHARDS)]  # ip -> (tokens, last_refill)
+# last_refill is time.monotonic(), so NTP steps can't wrongly expire or extend a bucket.
+_REFILL_RATE = RATE_LIMIT_MAX / RATE_LIMIT_WINDOW
+MAX_IPS = 100_000
+MAX_IPS_PER_SHARD = MAX_IPS // N_SHARDS
+SWEEP_INTERVAL = 60
+
+
+async def _sweep_ip_buckets() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        cutoff = time.monotonic() - 2 * RATE_LIMIT_WINDOW
+        for shard in _BUCKETS:
+            stale = [ip for ip, (_, last) in shard.items() if last < cutoff]
+            for ip in stale:
+                shard.pop(ip, None)
+            await asyncio.sleep(0)
+
+
+def rate_limited(request: Request) -> bool:
+    ip = get_client_ip(request)
+    shard = _BUCKETS[hash(ip) & (N_SHARDS - 1)]
+    now = time.monotonic()
+    tokens, last = shard.get(ip, (RATE_LIMIT_MAX, now))
+    tokens = min(RATE_LIMIT_MAX, tokens + (now - last) * _REFILL_RATE)
+    blocked = tokens < 1
+    shard[ip] = (tokens, now) if blocked else (tokens - 1, now)
+    shard.move_to_end(ip)
+    if len(shard) > MAX_IPS_PER_SHARD:
+        shard.popitem(last=False)
+    if blocked:
+        bump("blocked_rate")
+    return blocked
+
+
+async def _deterministic(user_input: str, mode: str, tone: str) -> Dict[str, Any]:
+    # Short inputs (memo hits or ~10µs misses) stay on the loop, where a thread hop
+    # would cost more than the work; only long ones are worth moving off it.
+    if len(user_input) <= MEMO_MAX_CHARS:
+        return deterministic_enhance(user_input, mode, tone)
+    return await asyncio.to_thread(deterministic_enhance, user_input, mode, tone)
+
+
+@app.post("/enhance", response_class=ORJSONResponse)
 async def enhance(request: Request):
     if rate_limited(request):
-        return JSONResponse({"error": "Too many requests, slow down."}, status_code=429)
+        return ORJSONResponse({"error": "Too many requests, slow down."}, status_code=429)
 
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
     except Exception:
-        return JSONResponse({"error": "Invalid JSON body."}, status_code=400)
+        return ORJSONResponse({"error": "Invalid JSON body."}, status_code=400)
 
     user_input: str = (body.get("input") or "").strip()
     mode: str = (body.get("mode") or "auto").strip().lower()   # --- DEFAULT NOW 'auto'
@@ -127,25 +588,33 @@ async def enhance(request: Request):
     tier: str = (body.get("tier") or "free").strip().lower()
 
     if not user_input:
-        return JSONResponse({"error": "input is required"}, status_code=400)
+        return ORJSONResponse({"error": "input is required"}, status_code=400)
 
     # --- ensure mode is inferred when needed ---
     if mode == "auto" or mode not in {"analytical","technical","creative","health"}:
         mode = infer_mode(user_input)
 
+    if tier == "batch":
+        return await submit_batch(user_input, mode, tone)
+
     if tier == "free":
-        COUNTERS["free_calls"] += 1
-        return JSONResponse(deterministic_enhance(user_input, mode, tone))
+        bump("free_calls")
+        return ORJSONResponse(await _deterministic(user_input, mode, tone))
 
     if tier == "pro":
-        COUNTERS["pro_calls"] += 1
+        bump("pro_calls")
+        key = cache_key(mode, tone, user_input)
+        cached = CACHE.get(key)
+        if cached:
+            return ORJSONResponse(cached, status_code=200)
         try:
             obj = await openrouter_enhance(user_input, mode, tone)
-            return JSONResponse(obj, status_code=200)
+            CACHE[key] = obj
+            return ORJSONResponse(obj, status_code=200)
         except Exception as e:
-            COUNTERS["fallback_uses"] += 1
-            fb = deterministic_enhance(user_input, mode, tone)
+            bump("fallback_uses")
+            fb = await _deterministic(user_input, mode, tone)
             fb["note"] = f"Provider unavailable: {str(e)[:120]}"
-            return JSONResponse(fb, status_code=200)
+            return ORJSONResponse(fb, status_code=200)
 
-    return JSONResponse({"error": "unknown tier"}, status_code=400)
+    return ORJSONResponse({"error": "unknown tier"}, status_code=400)